@@ -0,0 +1,77 @@
+"""
+Copyright (C) 2022-2025  Amelia Sutton
+This software is distributed under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version. See the file "[COPYING](COPYING)" for more details.
+"""
+import asyncio
+import logging
+from tqdm import tqdm
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2
+    http2 = True
+except ImportError:
+    http2 = False
+
+
+class AsyncRequester:
+    """
+    Issues FOLIO requests concurrently over a single keep-alive httpx.AsyncClient, using HTTP/2 when h2 is installed.
+    Takes the logged in requests session to copy its headers and token cookies, and limits the number of requests in flight.
+    """
+
+    def __init__(self, session, max_in_flight=100):
+        if httpx is None:
+            logging.critical("The async http backend requires httpx, install it with \"pip install httpx[http2]\"")
+            exit("The async http backend requires httpx")
+        self.session = session
+        self.maxInFlight = max_in_flight
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.maxInFlight)
+        self.client = httpx.AsyncClient(headers=dict(self.session.headers),
+                                        cookies=self.session.cookies.get_dict(),
+                                        http2=http2,
+                                        limits=httpx.Limits(max_connections=self.maxInFlight, max_keepalive_connections=self.maxInFlight),
+                                        timeout=60)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def _request(self, method, url, data=None):
+        async with self.semaphore:
+            return await self.client.request(method, url, content=data)
+
+    async def get(self, url):
+        return await self._request('GET', url)
+
+    async def put(self, url, data):
+        return await self._request('PUT', url, data)
+
+    async def post(self, url, data):
+        return await self._request('POST', url, data)
+
+
+def run_concurrently(session, max_in_flight, task, items, desc):
+    """
+    Runs task(requester, item) for every item concurrently on one AsyncRequester, returns the results in order.
+    An error in one item's task is logged and its result is None, so the other items still finish.
+    """
+    async def run_all():
+        async with AsyncRequester(session, max_in_flight) as requester:
+            with tqdm(total=len(items), desc=desc) as progress:
+                async def run(item):
+                    try:
+                        result = await task(requester, item)
+                    except Exception as e:
+                        logging.error(f"Request for {item} failed: {e!r}")
+                        result = None
+                    progress.update()
+                    return result
+                return await asyncio.gather(*(run(item) for item in items))
+    return asyncio.run(run_all())
@@ -0,0 +1,33 @@
+"""
+Copyright (C) 2022-2025  Amelia Sutton
+This software is distributed under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version. See the file "[COPYING](COPYING)" for more details.
+"""
+import logging
+
+
+def cohort_user_ids(session, url, user_info, column_index=None, column_value=None, query=None):
+    """
+    Returns the ids of the users matching a CQL query against users, or whose user info column matches a value.
+    Takes the updater's session, base url and userInfo dictionary.
+    """
+    if query:
+        user_ids = []
+        offset = 0
+        while True:
+            usersURL = f'{url}users'
+            params = {'query': f'({query}) sortBy id', 'limit': 1000, 'offset': offset}
+            request = session.get(usersURL, params=params)
+            if request.status_code != 200:
+                logging.critical(f'User query {query} failed, response code: {request.status_code}, url: {usersURL}, params: {params}')
+                raise ValueError
+            users = request.json()['users']
+            user_ids += [user['id'] for user in users]
+            if len(users) < 1000:
+                return user_ids
+            offset += 1000
+    if column_index is None:
+        logging.critical("No cohort selector provided, a column index and value or a users query is required")
+        raise ValueError
+    return [user_id for user_id, info in user_info.items() if len(info) > column_index and info[column_index] == column_value]
@@ -0,0 +1,82 @@
+"""
+Copyright (C) 2022-2025  Amelia Sutton
+This software is distributed under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version. See the file "[COPYING](COPYING)" for more details.
+"""
+import csv
+import json
+import logging
+import mmap
+import os
+
+
+class DataFileIndex:
+    """
+    On disk index of a tab delimited data file, mapping each user id to the byte offset and length of its row.
+    The index is saved next to the data file and rebuilt whenever the data file's size or modification time changes,
+    rows are read through a memory map so only the requested rows are parsed.
+    """
+
+    def __init__(self, data_file, user_id_column_index):
+        self.dataFile = data_file
+        self.indexFile = f'{data_file}.idx'
+        self.userIdColumnIndex = user_id_column_index
+        self.offsets = self._load_index()
+        if self.offsets is None:
+            self.offsets = self._build_index()
+
+    def _file_stamp(self):
+        stat = os.stat(self.dataFile)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _parse_row(self, line):
+        return next(csv.reader([line.decode('utf-8').rstrip('\r\n')], delimiter='\t'))
+
+    def _load_index(self):
+        """Returns the saved index if it is still valid for the data file, otherwise None"""
+        try:
+            with open(self.indexFile, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if index.get('stamp') != self._file_stamp() or index.get('userIdColumnIndex') != self.userIdColumnIndex:
+            logging.info(f"Row index for {self.dataFile} is out of date")
+            return None
+        return index['offsets']
+
+    def _build_index(self):
+        """Scans the data file once, saving and returning the offset and length of each user's row"""
+        logging.info(f"Building row index for {self.dataFile}...")
+        stamp = self._file_stamp()
+        offsets = {}
+        if stamp[0] > 0:
+            with open(self.dataFile, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Skips the header row
+                data.readline()
+                offset = data.tell()
+                for line in iter(data.readline, b''):
+                    row = self._parse_row(line)
+                    if len(row) > self.userIdColumnIndex and row[self.userIdColumnIndex] != '':
+                        offsets[row[self.userIdColumnIndex]] = [offset, len(line)]
+                    offset += len(line)
+        with open(self.indexFile, 'w') as file:
+            json.dump({'stamp': stamp, 'userIdColumnIndex': self.userIdColumnIndex, 'offsets': offsets}, file)
+        logging.info(f"Row index built for {len(offsets)} users")
+        return offsets
+
+    def rows(self, user_ids):
+        """Reads and parses the rows for the given user ids, user ids not in the data file are logged and skipped"""
+        missing = [user_id for user_id in user_ids if user_id not in self.offsets]
+        if missing:
+            logging.warning(f"User ids not found in {self.dataFile}: {missing}")
+        if not self.offsets:
+            # Nothing to read, and an empty data file cannot be memory mapped
+            return []
+        rows = []
+        with open(self.dataFile, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for user_id in dict.fromkeys(user_ids):
+                if user_id in self.offsets:
+                    offset, length = self.offsets[user_id]
+                    rows.append(self._parse_row(data[offset:offset+length]))
+        return rows
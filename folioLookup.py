@@ -0,0 +1,42 @@
+"""
+Copyright (C) 2022-2025  Amelia Sutton
+This software is distributed under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version. See the file "[COPYING](COPYING)" for more details.
+"""
+import logging
+from tqdm import tqdm
+
+
+def cql_term(value):
+    """Quotes a value for use in a CQL query, escaping the characters CQL treats as special"""
+    for character in '\\"*?^':
+        value = value.replace(character, '\\' + character)
+    return f'"{value}"'
+
+
+def batched_name_lookup(session, url, names, fields, records_key, id_field, limit_param, batch_size, desc):
+    """
+    Looks up records at url by each of fields in turn, querying only the names not yet matched, batch_size names per request.
+    Returns a dictionary of name to the matching record's id_field value, and the list of names that were not found.
+    FOLIO compares == case insensitively, so results are matched to names on a casefolded key.
+    """
+    unresolved = list(dict.fromkeys(names))
+    found = {}
+    for field in fields:
+        for i in tqdm(range(0, len(unresolved), batch_size), desc=f"{desc} by {field}"):
+            batch = unresolved[i:i+batch_size]
+            batchNames = {}
+            for name in batch:
+                batchNames.setdefault(name.casefold(), []).append(name)
+            terms = ' or '.join(cql_term(name) for name in batch)
+            params = {'query': f'{field}==({terms})', limit_param: 1000}
+            request = session.get(url, params=params)
+            if request.status_code != 200:
+                logging.critical(f'{desc} failed, response code: {request.status_code}, url: {url}, params: {params}, headers: {session.headers}')
+                raise ValueError
+            for record in request.json()[records_key]:
+                for name in batchNames.get((record.get(field) or '').casefold(), []):
+                    found.setdefault(name, record[id_field])
+        unresolved = [name for name in unresolved if name not in found]
+    return found, unresolved
@@ -4,12 +4,17 @@ import requests
 import os
 import csv
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from asyncRequester import run_concurrently
+from dataFileIndex import DataFileIndex
+from cohortSelector import cohort_user_ids
+from folioLookup import cql_term, batched_name_lookup
 from datetime import datetime
 
 
 class PermissionUpdater:
     
-    def __init__(self, envfile=None):
+    def __init__(self, envfile=None, user_ids=None, data_file_mode='full'):
         logging.info("Initializing Permission Updater...")
         logging.info("Reading .env configuration file...")
         if envfile:
@@ -23,6 +28,10 @@ class PermissionUpdater:
             self.tenant = os.getenv('tenant')
             self.userFile = os.getenv('perms_file')
             self.userIdColumnIndex = int(os.getenv('user_id_column_index'))
+            self.batchSize = int(os.getenv('batch_size', 50))
+            self.maxWorkers = int(os.getenv('max_workers', 8))
+            self.httpBackend = os.getenv('http_backend', 'sync').lower()
+            self.maxInFlight = int(os.getenv('max_in_flight', 100))
         else:
             logging.critical(f".env file, \"{self.env}\"  not found or one or more required fields missing from .env")
             exit(".env file missing or required field(s) missing from .env")
@@ -40,33 +49,36 @@ class PermissionUpdater:
         logging.info("API token retrieved!")
     
         logging.info("Parsing Data file...")
+        # data_file_mode is 'full' to load and resolve every row, 'user_info' to load only the user data columns
+        # without resolving any names, or 'none' when users are selected by a query and the data file is not needed
+        self.userSubset = bool(user_ids) or data_file_mode != 'full'
         try:
-            with open(self.userFile, 'r') as file:
-                userPermissionsReader = csv.reader(file, delimiter='\t')
-                # Prepares the user Permissions dictionary
+            if data_file_mode == 'none':
                 userPermissionsContents = []
-                for i, row in enumerate(userPermissionsReader):
-                    if i >= 1 and row[self.userIdColumnIndex]!= '':
-                        userPermissionsContents.append(row)
+            elif user_ids:
+                # Reads only the requested users' rows through the data file's row index
+                userPermissionsContents = DataFileIndex(self.userFile, self.userIdColumnIndex).rows(user_ids)
+            else:
+                with open(self.userFile, 'r') as file:
+                    userPermissionsReader = csv.reader(file, delimiter='\t')
+                    # Prepares the user Permissions dictionary
+                    userPermissionsContents = []
+                    for i, row in enumerate(userPermissionsReader):
+                        if i >= 1 and row[self.userIdColumnIndex]!= '':
+                            userPermissionsContents.append(row)
         except Exception as e:
             logging.critical(f"Data file, \"{self.userFile}\" not found or was formatted incorrectly")
             raise e
-        permissions = []
-        permissionDict = {}
         self.userPermissions = {}
         self.userInfo = {}
-        for row in tqdm(userPermissionsContents, desc = "Parsing data file and looking up permission ids"):
-            self.userInfo[row[self.userIdColumnIndex]] = []
-            self.userPermissions[row[self.userIdColumnIndex]] = []
-            for i, column in enumerate(row):
-                if i<self.userIdColumnIndex:
-                    self.userInfo[row[self.userIdColumnIndex]].append(column)
-                if i>self.userIdColumnIndex and column != '':
-                    if column not in permissions:
-                        permissions.append(column)
-                        permissionDict[column] = self._permission_id_lookup(column)
-                    self.userPermissions[row[self.userIdColumnIndex]].append(permissionDict[column])
+        for row in userPermissionsContents:
+            self.userInfo[row[self.userIdColumnIndex]] = row[:self.userIdColumnIndex]
+        if data_file_mode == 'full':
+            permissionDict = self._permission_ids_lookup(column for row in userPermissionsContents for column in row[self.userIdColumnIndex+1:] if column != '')
+            for row in tqdm(userPermissionsContents, desc = "Parsing data file"):
+                self.userPermissions[row[self.userIdColumnIndex]] = [permissionDict[column] for column in row[self.userIdColumnIndex+1:] if column != '']
         logging.info("Data file parsed successfully")
+        self.writtenUsers = set()
         logging.info("Permission Updater Initialized")
 
     def _retrieve_token(self, user, password):
@@ -81,18 +93,18 @@ class PermissionUpdater:
         else:
             return 0
 
-    def _permission_id_lookup(self, permission_name):
-        permSetURL = f'{self.url}perms/permissions?query=displayName=="{permission_name}" OR permissionName=="{permission_name}"'
-        request = self.session.get(permSetURL)
-        if request.status_code != 200:
-            logging.critical(f'Permission {permission_name} not found, response code: {request.status_code}, url: {permSetURL}, headers: {self.session.headers}')
-            raise ValueError
-        response = request.json()
-        if len(response['permissions']) == 0:
-            logging.critical(f'Permission {permission_name} not found')
-            raise ValueError
-        perm_id = response['permissions'][0]['permissionName']
-        return perm_id
+    def _permission_ids_lookup(self, permission_names):
+        """
+        Looks up permissions by permissionName, then by displayName for any names not matched, in batches.
+        Returns a dictionary of each name to its permissionName, raises ValueError listing every name not found.
+        """
+        permissionDict, unresolved = batched_name_lookup(self.session, f'{self.url}perms/permissions', permission_names,
+                                                         ('permissionName', 'displayName'), 'permissions', 'permissionName',
+                                                         'length', self.batchSize, "Looking up permission ids")
+        if unresolved:
+            logging.critical(f'Permissions not found: {unresolved}')
+            raise ValueError(f'Permissions not found: {unresolved}')
+        return permissionDict
     
     def _permission_name_lookup(self, permission_id):
         permSetURL = f'{self.url}perms/permissions?query=permissionName=={permission_id}'
@@ -123,26 +135,141 @@ class PermissionUpdater:
         else:
             return True, perm_user_id
 
-    def _permission_put(self, user_id, perm_user_id , permission_list):
-        permissionURL = f'{self.url}perms/users/{perm_user_id}'
-        payload = str({
+    def _permission_payload(self, user_id, perm_user_id, permission_list):
+        return str({
             'id' : perm_user_id,
             'userId': user_id,
             'permissions': permission_list
         }).replace('\'','\"')
+
+    def _permission_put(self, user_id, perm_user_id , permission_list):
+        permissionURL = f'{self.url}perms/users/{perm_user_id}'
+        payload = self._permission_payload(user_id, perm_user_id, permission_list)
         logging.info(f"Updating user with id: {user_id} assigning the following permissions: {permission_list}")
         request = self.session.put(permissionURL, data=str(payload))
+        self.writtenUsers.add(user_id)
         if request.status_code == 200:
             logging.info(f"Permissions updated for user with id: {user_id}")
         else:
-            logging.info(request.text)
+            logging.warning(f"Permission update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
         return [user_id, request.status_code, str(permission_list), str(permissionURL), str(payload), str(self.session.headers)]
 
+    async def _apply_user_permission_async(self, requester, user_id):
+        """Async backend equivalent of comparing and updating the permissions of a single user"""
+        permUserURL = f'{self.url}perms/users/{user_id}?full=true&indexField=userId'
+        request = await requester.get(permUserURL)
+        if request.status_code >= 400:
+            logging.warning(f'User with id: {user_id} not found')
+            return
+        response = request.json()
+        if sorted(self.userPermissions[user_id]) == sorted(response['permissions']):
+            logging.info(f"Permissions for User with id {user_id} required no changes")
+            return
+        permission_list = self.userPermissions[user_id]
+        permissionURL = f'{self.url}perms/users/{response["id"]}'
+        payload = self._permission_payload(user_id, response['id'], permission_list)
+        logging.info(f"Updating user with id: {user_id} assigning the following permissions: {permission_list}")
+        request = await requester.put(permissionURL, payload)
+        self.writtenUsers.add(user_id)
+        if request.status_code == 200:
+            logging.info(f"Permissions updated for user with id: {user_id}")
+        else:
+            logging.warning(f"Permission update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
+
+    def _get_current_perms_batch(self, user_ids):
+        """Retrieves the permission user records for a batch of users, returns a dictionary of user id to (permission user id, permissions)"""
+        # FOLIO compares ids case insensitively but returns them in lower case, so results are mapped back to the requested ids
+        requested = {user_id.lower(): user_id for user_id in user_ids}
+        userIdQuery = ' or '.join(cql_term(user_id) for user_id in requested)
+        permUsersURL = f'{self.url}perms/users'
+        params = {'query': f'userId==({userIdQuery})', 'length': len(requested)}
+        request = self.session.get(permUsersURL, params=params)
+        if request.status_code != 200:
+            logging.critical(f'Permission user lookup failed, response code: {request.status_code}, url: {permUsersURL}, params: {params}')
+            raise ValueError
+        current_perms = {}
+        for perm_user in request.json()['permissionUsers']:
+            if perm_user['userId'].lower() in requested:
+                current_perms[requested[perm_user['userId'].lower()]] = (perm_user['id'], perm_user['permissions'])
+        return current_perms
+
+    def _get_permission_catalog(self):
+        """Retrieves every permission defined in FOLIO, returns a dictionary of permission name to permission record"""
+        catalog = {}
+        start = 1
+        while True:
+            catalogURL = f'{self.url}perms/permissions?expandSubs=false&length=1000&start={start}'
+            request = self.session.get(catalogURL)
+            if request.status_code != 200:
+                logging.critical(f'Permission catalog retrieval failed, response code: {request.status_code}, url: {catalogURL}')
+                raise ValueError
+            permissions = request.json()['permissions']
+            for permission in permissions:
+                catalog[permission['permissionName']] = permission
+            if len(permissions) < 1000:
+                return catalog
+            start += 1000
+
+    def _expand_permission(self, permission_name, catalog, expanded):
+        """
+        Returns the set of permission names granted by a permission, including all nested sub permissions.
+        Uses Tarjan's algorithm so every permission in a cycle of permission sets is given the same complete closure,
+        closures are only stored in expanded once their strongly connected component is finished.
+        """
+        if permission_name in expanded:
+            return expanded[permission_name]
+        def sub_permissions(name):
+            return catalog.get(name, {}).get('subPermissions', [])
+        index = {permission_name: 0}
+        lowlink = {permission_name: 0}
+        stack = [permission_name]
+        on_stack = {permission_name}
+        # Each work item is a permission and an iterator over the sub permissions still to visit
+        work = [(permission_name, iter(sub_permissions(permission_name)))]
+        while work:
+            name, children = work[-1]
+            for child in children:
+                if child in expanded:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sub_permissions(child))))
+                    break
+                if child in on_stack:
+                    lowlink[name] = min(lowlink[name], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] == index[name]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == name:
+                            break
+                    # Components reachable from this one are already finished, so their closures are complete
+                    closure = set(component)
+                    for member in component:
+                        for child in sub_permissions(member):
+                            if child not in closure:
+                                closure |= expanded[child]
+                    for member in component:
+                        expanded[member] = closure
+        return expanded[permission_name]
+
     def get_user_permissions_table(self):
         return str(self.userPermissions)
     
     def rebuild_permissions_csv(self):
         logging.info("Rebuilding Permissions csv file to match data in FOLIO...")
+        if self.userSubset:
+            logging.critical(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
+            raise RuntimeError(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
         currentUserPermissions = {}
         unique_perms = []
         
@@ -190,6 +317,10 @@ class PermissionUpdater:
 
     def apply_user_permissions(self):
         logging.info("Applying Permissions in FOLIO...")
+        if self.httpBackend == 'async':
+            run_concurrently(self.session, self.maxInFlight, self._apply_user_permission_async, list(self.userPermissions.keys()), "Applying permissions in FOLIO")
+            logging.info("All permissions applied in FOLIO")
+            return 0
         for user_id in tqdm(self.userPermissions.keys(), desc= "Applying permissions in FOLIO"):
             updated, perm_user_id = self._perm_comparison(user_id=user_id)
             if updated:
@@ -197,6 +328,140 @@ class PermissionUpdater:
                 self._permission_put(user_id=user_id, perm_user_id=perm_user_id, permission_list=permissions)
         logging.info("All permissions applied in FOLIO")
         return 0
+
+    def verify_user_permissions(self, user_ids=None, retries=2):
+        """
+        Re-reads the permissions of the users written by this updater (or the given users) in batches and compares them against the data file.
+        Mismatched users are updated again up to retries times.
+        Returns a dictionary of user id to (missing permissions, unexpected permissions) for the users still mismatched.
+        """
+        logging.info("Verifying Permissions in FOLIO...")
+        user_ids = [user_id for user_id in (self.writtenUsers if user_ids is None else user_ids) if user_id in self.userPermissions]
+        for attempt in range(retries + 1):
+            mismatches = {}
+            perm_user_ids = {}
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Verifying permissions in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                current_perms = self._get_current_perms_batch(batch)
+                for user_id in batch:
+                    intended = set(self.userPermissions[user_id])
+                    perm_user_id, existing_perms = current_perms.get(user_id, ('', []))
+                    existing = set(existing_perms)
+                    if intended != existing:
+                        mismatches[user_id] = (intended - existing, existing - intended)
+                        if perm_user_id:
+                            perm_user_ids[user_id] = perm_user_id
+            if not perm_user_ids or attempt == retries:
+                break
+            logging.warning(f"{len(mismatches)} users do not match the data file, retrying update ({attempt + 1} of {retries})")
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                retries_submitted = [executor.submit(self._permission_put, user_id=user_id, perm_user_id=perm_user_id, permission_list=self.userPermissions[user_id])
+                                     for user_id, perm_user_id in perm_user_ids.items()]
+                for retry in retries_submitted:
+                    retry.result()
+            user_ids = list(mismatches.keys())
+        for user_id, (missing, unexpected) in mismatches.items():
+            logging.error(f"Permissions mismatch for user with id: {user_id} missing: {sorted(missing)} unexpected: {sorted(unexpected)}")
+        logging.info(f"Permission verification complete, {len(mismatches)} users do not match the data file")
+        return mismatches
+
+    def build_effective_permissions_index(self):
+        """
+        Computes the effective permissions of every user in the data file by expanding their permission sets locally
+        against the permission catalog, and builds an index of permission name to the users holding it.
+        """
+        logging.info("Building effective permissions index...")
+        self.permissionCatalog = self._get_permission_catalog()
+        self.permissionDisplayNames = {}
+        for name, record in self.permissionCatalog.items():
+            self.permissionDisplayNames.setdefault(record.get('displayName'), name)
+        expanded = {}
+        self.effectivePermissions = {}
+        self.permissionHolders = {}
+        user_ids = list(self.userPermissions.keys())
+        for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Computing effective user permissions"):
+            current_perms = self._get_current_perms_batch(user_ids[i:i+self.batchSize])
+            for user_id, (perm_user_id, user_perms) in current_perms.items():
+                effective = set()
+                for permission in user_perms:
+                    effective |= self._expand_permission(permission, self.permissionCatalog, expanded)
+                self.effectivePermissions[user_id] = effective
+                for permission in effective:
+                    self.permissionHolders.setdefault(permission, set()).add(user_id)
+        logging.info(f"Effective permissions index built for {len(self.effectivePermissions)} users")
+        return 0
+
+    def _catalog_permission_name(self, permission):
+        """Takes a permission displayName or permissionName and returns its permissionName, or None if it is not in the catalog"""
+        if not hasattr(self, 'permissionHolders'):
+            self.build_effective_permissions_index()
+        if permission in self.permissionCatalog:
+            return permission
+        return self.permissionDisplayNames.get(permission)
+
+    def users_with_permission(self, permission):
+        """
+        Takes a permission displayName or permissionName and returns the ids of the users who effectively hold it.
+        Raises ValueError if the permission is not in the catalog.
+        """
+        permission_name = self._catalog_permission_name(permission)
+        if permission_name is None:
+            logging.critical(f'Permission {permission} not found')
+            raise ValueError(f'Permission {permission} not found')
+        return sorted(self.permissionHolders.get(permission_name, set()))
+
+    def audit_effective_permissions(self, permissions, audit_file):
+        """Writes a tab delimited file listing every user in the data file who effectively holds each of the given permissions"""
+        logging.info(f"Auditing effective permissions: {permissions}")
+        # Checks every name before writing so a typo cannot produce an audit that looks like nobody holds it
+        unknown = [permission for permission in permissions if self._catalog_permission_name(permission) is None]
+        if unknown:
+            logging.critical(f'Permissions not found: {unknown}')
+            raise ValueError(f'Permissions not found: {unknown}')
+        with open(audit_file, 'w', encoding="utf-8") as file:
+            data_headers = 'User Data\t'*self.userIdColumnIndex
+            file.write(f"{data_headers}User Id\tPermission\n")
+            for permission in permissions:
+                holders = self.users_with_permission(permission)
+                logging.info(f"{len(holders)} users effectively hold permission {permission}")
+                for user_id in holders:
+                    user_data = ''.join(f"{data}\t" for data in self.userInfo[user_id])
+                    file.write(f"{user_data}{user_id}\t{permission}\n")
+        logging.info(f"Audit written to {audit_file}")
+        return 0
+
+    def apply_cohort_permissions(self, add=None, remove=None, column_index=None, column_value=None, query=None):
+        """
+        Adds and removes permissions for every user selected by a userInfo column value or a CQL query against users.
+        Current permissions are read in batches and only users whose permissions change are updated.
+        """
+        logging.info("Applying cohort permission changes in FOLIO...")
+        permissionDict = self._permission_ids_lookup((add or []) + (remove or []))
+        add_ids = list(dict.fromkeys(permissionDict[permission] for permission in (add or [])))
+        remove_ids = {permissionDict[permission] for permission in (remove or [])}
+        user_ids = cohort_user_ids(self.session, self.url, self.userInfo, column_index=column_index, column_value=column_value, query=query)
+        logging.info(f"{len(user_ids)} users selected, adding the following permissions: {add_ids}, removing the following permissions: {list(remove_ids)}")
+        updates = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Applying cohort permissions in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                current_perms = self._get_current_perms_batch(batch)
+                for user_id in batch:
+                    if user_id not in current_perms:
+                        logging.warning(f'User with id: {user_id} not found')
+                        continue
+                    perm_user_id, existing_perms = current_perms[user_id]
+                    permissions = [perm for perm in existing_perms if perm not in remove_ids] + [perm for perm in add_ids if perm not in existing_perms]
+                    if permissions == existing_perms:
+                        logging.info(f"Permissions for User with id {user_id} required no changes")
+                        continue
+                    updates.append(executor.submit(self._permission_put, user_id=user_id, perm_user_id=perm_user_id, permission_list=permissions))
+            results = [update.result() for update in updates]
+        failed = [result[0] for result in results if result[1] != 200]
+        if failed:
+            logging.error(f"Cohort permissions update failed for {len(failed)} users: {failed}")
+        logging.info(f"Cohort permissions applied in FOLIO, {len(results) - len(failed)} users updated")
+        return 0
               
 
 if __name__ == '__main__':
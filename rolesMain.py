@@ -7,9 +7,21 @@ the Free Software Foundation, either version 3 of the License, or
 from servicePointUpdater import ServicePointUpdater
 from rolesUpdater import RolesUpdater
 from datetime import datetime
+import argparse
 import logging
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Updates the permissions and service points assigned to users in FOLIO")
+    parser.add_argument('--users', help="comma separated user ids, only these users' rows are loaded from the data files")
+    parser.add_argument('--users-file', help="file of user ids, one per line, only these users' rows are loaded from the data files")
+    args = parser.parse_args()
+    userIds = None
+    if args.users:
+        userIds = [user_id.strip() for user_id in args.users.split(',') if user_id.strip()]
+    elif args.users_file:
+        with open(args.users_file, 'r') as file:
+            userIds = [line.strip() for line in file if line.strip()]
+
     start_time = datetime.now()
 
     logpath = "Test Logs"
@@ -22,19 +34,22 @@ if __name__ == '__main__':
     env = input("Which .env file should be used?\n")
 
     if env.lower() == "staff":
-        rolesUpdater = RolesUpdater("UM Staff.env")
-        servicePointUpdater = ServicePointUpdater("UM Staff.env")
+        envFile = "UM Staff.env"
     elif (env.lower() == "students" or env.lower()=="student"):
-        rolesUpdater = RolesUpdater("UM Student.env")
-        servicePointUpdater = ServicePointUpdater("UM Student.env")
+        envFile = "UM Student.env"
     elif env.lower() == "test":
-        rolesUpdater = RolesUpdater("Test.env")
-        servicePointUpdater = ServicePointUpdater("Test.env")
+        envFile = "Test.env"
     else:
-        rolesUpdater = RolesUpdater(env)
-        servicePointUpdater = ServicePointUpdater(env)
+        envFile = env
+
+    action = input("What would you like to do? (Refresh/Apply/Cohort)\n") 
+
+    if action.lower() == "refresh" and userIds:
+        parser.error("--users and --users-file cannot be used with refresh, it rewrites the whole data files")
 
-    action = input("What would you like to do? (Refresh/Apply)\n") 
+    if action.lower() in ("refresh", "apply"):
+        rolesUpdater = RolesUpdater(envFile, user_ids=userIds)
+        servicePointUpdater = ServicePointUpdater(envFile, user_ids=userIds)
 
     if action.lower() == "refresh":
         rolesUpdater.rebuild_permissions_csv()
@@ -42,3 +57,31 @@ if __name__ == '__main__':
     elif action.lower() == "apply":
         rolesUpdater.apply_user_permissions()
         servicePointUpdater.apply_user_service_points()
+        permissionMismatches = rolesUpdater.verify_user_permissions()
+        servicePointMismatches = servicePointUpdater.verify_user_service_points()
+        if permissionMismatches or servicePointMismatches:
+            print(f"{len(permissionMismatches)} users' permissions and {len(servicePointMismatches)} users' service points do not match the data files, see the log for details")
+    elif action.lower() == "cohort":
+        selector = input("Select users by a data column value or a users CQL query? (Column/Query)\n")
+        if selector.lower() == "query":
+            selection = {'query': input("Enter the CQL query for the users to update\n")}
+        else:
+            selection = {'column_index': int(input("Which data column should be matched? (0 based index)\n")),
+                        'column_value': input("Which value should the column match?\n")}
+        target = input("What should be updated? (Permissions/Service Points)\n")
+        add = [value.strip() for value in input("Enter the names to add, separated by commas\n").split(',') if value.strip()]
+        remove = [value.strip() for value in input("Enter the names to remove, separated by commas\n").split(',') if value.strip()]
+        # Only the updater being used is created, and only the user data columns are read when selecting by column
+        dataFileMode = 'none' if 'query' in selection else 'user_info'
+        if target.lower() == "permissions":
+            rolesUpdater = RolesUpdater(envFile, user_ids=userIds, data_file_mode=dataFileMode)
+            rolesUpdater.apply_cohort_permissions(add=add, remove=remove, **selection)
+        elif target.lower() in ("service points", "service point"):
+            default = input("Enter the default service point code, or leave blank to keep the current default\n").strip()
+            servicePointUpdater = ServicePointUpdater(envFile, user_ids=userIds, data_file_mode=dataFileMode)
+            servicePointUpdater.apply_cohort_service_points(add=add, remove=remove, default=default or None, **selection)
+        # Cohort changes are only made in FOLIO, applying the old data files would undo them
+        print("WARNING: the data files do not include these changes, running Apply before a Refresh will undo them")
+        if not userIds and input("Refresh the data files now? (Yes/No)\n").lower() in ("yes", "y"):
+            RolesUpdater(envFile).rebuild_permissions_csv()
+            ServicePointUpdater(envFile).rebuild_service_points_csv()
@@ -4,12 +4,17 @@ import requests
 import os
 import csv
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from asyncRequester import run_concurrently
+from dataFileIndex import DataFileIndex
+from cohortSelector import cohort_user_ids
+from folioLookup import cql_term, batched_name_lookup
 from datetime import datetime
 
 
 class RolesUpdater:
     
-    def __init__(self, envfile=None):
+    def __init__(self, envfile=None, user_ids=None, data_file_mode='full'):
         logging.info("Initializing Permission Updater...")
         logging.info("Reading .env configuration file...")
         if envfile:
@@ -23,6 +28,10 @@ class RolesUpdater:
             self.tenant = os.getenv('tenant')
             self.userFile = os.getenv('perms_file')
             self.userIdColumnIndex = int(os.getenv('user_id_column_index'))
+            self.batchSize = int(os.getenv('batch_size', 50))
+            self.maxWorkers = int(os.getenv('max_workers', 8))
+            self.httpBackend = os.getenv('http_backend', 'sync').lower()
+            self.maxInFlight = int(os.getenv('max_in_flight', 100))
         else:
             logging.critical(f".env file, \"{self.env}\"  not found or one or more required fields missing from .env")
             exit(".env file missing or required field(s) missing from .env")
@@ -40,33 +49,36 @@ class RolesUpdater:
         logging.info("API token retrieved!")
     
         logging.info("Parsing Data file...")
+        # data_file_mode is 'full' to load and resolve every row, 'user_info' to load only the user data columns
+        # without resolving any names, or 'none' when users are selected by a query and the data file is not needed
+        self.userSubset = bool(user_ids) or data_file_mode != 'full'
         try:
-            with open(self.userFile, 'r') as file:
-                userPermissionsReader = csv.reader(file, delimiter='\t')
-                # Prepares the user Permissions dictionary
+            if data_file_mode == 'none':
                 userPermissionsContents = []
-                for i, row in enumerate(userPermissionsReader):
-                    if i >= 1 and row[self.userIdColumnIndex]!= '':
-                        userPermissionsContents.append(row)
+            elif user_ids:
+                # Reads only the requested users' rows through the data file's row index
+                userPermissionsContents = DataFileIndex(self.userFile, self.userIdColumnIndex).rows(user_ids)
+            else:
+                with open(self.userFile, 'r') as file:
+                    userPermissionsReader = csv.reader(file, delimiter='\t')
+                    # Prepares the user Permissions dictionary
+                    userPermissionsContents = []
+                    for i, row in enumerate(userPermissionsReader):
+                        if i >= 1 and row[self.userIdColumnIndex]!= '':
+                            userPermissionsContents.append(row)
         except Exception as e:
             logging.critical(f"Data file, \"{self.userFile}\" not found or was formatted incorrectly")
             raise e
-        permissions = []
-        permissionDict = {}
         self.userPermissions = {}
         self.userInfo = {}
-        for row in tqdm(userPermissionsContents, desc = "Parsing data file and looking up permission ids"):
-            self.userInfo[row[self.userIdColumnIndex]] = []
-            self.userPermissions[row[self.userIdColumnIndex]] = []
-            for i, column in enumerate(row):
-                if i<self.userIdColumnIndex:
-                    self.userInfo[row[self.userIdColumnIndex]].append(column)
-                if i>self.userIdColumnIndex and column != '':
-                    if column not in permissions:
-                        permissions.append(column)
-                        permissionDict[column] = self._permission_id_lookup(column)
-                    self.userPermissions[row[self.userIdColumnIndex]].append(permissionDict[column])
+        for row in userPermissionsContents:
+            self.userInfo[row[self.userIdColumnIndex]] = row[:self.userIdColumnIndex]
+        if data_file_mode == 'full':
+            permissionDict = self._permission_ids_lookup(column for row in userPermissionsContents for column in row[self.userIdColumnIndex+1:] if column != '')
+            for row in tqdm(userPermissionsContents, desc = "Parsing data file"):
+                self.userPermissions[row[self.userIdColumnIndex]] = [permissionDict[column] for column in row[self.userIdColumnIndex+1:] if column != '']
         logging.info("Data file parsed successfully")
+        self.writtenUsers = set()
         logging.info("Permission Updater Initialized")
 
     def _retrieve_token(self, user, password):
@@ -81,18 +93,18 @@ class RolesUpdater:
         else:
             return 0
 
-    def _permission_id_lookup(self, permission_name):
-        permSetURL = f'{self.url}roles?query=name=="{permission_name}"'
-        request = self.session.get(permSetURL)
-        if request.status_code != 200:
-            logging.critical(f'Permission {permission_name} not found, response code: {request.status_code}, url: {permSetURL}, headers: {self.session.headers}')
-            raise ValueError
-        response = request.json()
-        if len(response['roles']) == 0:
-            logging.critical(f'Permission {permission_name} not found')
-            raise ValueError
-        perm_id = response['roles'][0]['id']
-        return perm_id
+    def _permission_ids_lookup(self, permission_names):
+        """
+        Looks up roles by name in batches.
+        Returns a dictionary of each name to its role id, raises ValueError listing every name not found.
+        """
+        permissionDict, unresolved = batched_name_lookup(self.session, f'{self.url}roles', permission_names,
+                                                         ('name',), 'roles', 'id',
+                                                         'limit', self.batchSize, "Looking up role ids")
+        if unresolved:
+            logging.critical(f'Permissions not found: {unresolved}')
+            raise ValueError(f'Permissions not found: {unresolved}')
+        return permissionDict
     
     def _permission_name_lookup(self, permission_id):
         permSetURL = f'{self.url}roles/{permission_id}'
@@ -132,12 +144,20 @@ class RolesUpdater:
         logging.info(f"Retrieving User Record with id: {user_id}")
         userGetURL = f'{self.url}users/{user_id}'
         userRequest = self.session.get(userGetURL)
-        userRecord = str(userRequest.json()).replace("'",'"').replace("True", "true").replace("False","false")
+        userRecord = self._keycloak_user_record(userRequest.json())
         logging.info(f"User record retrieved")
     
         logging.info(f"Creating keycloak user record for user with id: {user_id}...")
         keycloakUserURL = f'{self.url}users-keycloak/users'
         keycloakRequest = self.session.post(keycloakUserURL, data=userRecord)
+        return self._keycloak_user_created(user_id, keycloakRequest)
+
+    def _keycloak_user_record(self, user):
+        """Takes a User record and returns the payload for creating its keycloak user record"""
+        return str(user).replace("'",'"').replace("True", "true").replace("False","false")
+
+    def _keycloak_user_created(self, user_id, keycloakRequest):
+        """Checks the response to a keycloak user creation request, raises RuntimeError if it failed"""
         if keycloakRequest.status_code != 201:
             logging.critical(f'Keycloak User creation for user with id: {user_id} failed: {keycloakRequest.text}')
             raise RuntimeError
@@ -145,14 +165,18 @@ class RolesUpdater:
             logging.info(f"Keycloak user record created for user with id: {user_id}")
             return True
 
-    def _permission_put(self, user_id, permission_list):
-        permissionURL = f'{self.url}roles/users/{user_id}'
-        payload = str({
+    def _permission_payload(self, user_id, permission_list):
+        return str({
             'userId': user_id,
             'roleIds': permission_list
         }).replace('\'','\"')
+
+    def _permission_put(self, user_id, permission_list):
+        permissionURL = f'{self.url}roles/users/{user_id}'
+        payload = self._permission_payload(user_id, permission_list)
         logging.info(f"Updating user with id: {user_id} assigning the following permissions: {permission_list}")
         request = self.session.put(permissionURL, data=str(payload))
+        self.writtenUsers.add(user_id)
         if request.status_code == 200:
             logging.info(f"Permissions updated for user with id: {user_id}")
         if request.status_code == 404:
@@ -162,15 +186,70 @@ class RolesUpdater:
                 # Moved to other function
                 if self._create_keycloak_user(user_id):
                     return self._permission_put(user_id, permission_list)
-        else:
-            logging.info(request.text)
+        elif request.status_code != 200:
+            logging.warning(f"Permission update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
         return [user_id, request.status_code, str(permission_list), str(permissionURL), str(payload), str(self.session.headers)]
 
+    async def _apply_user_permission_async(self, requester, user_id):
+        """Async backend equivalent of comparing and updating the roles of a single user"""
+        request = await requester.get(f'{self.url}roles/users/{user_id}')
+        if request.status_code >= 400:
+            logging.warning(f'User with id: {user_id} not found')
+            existing_perms = []
+        else:
+            existing_perms = [role['roleId'] for role in request.json()['userRoles']]
+        if sorted(self.userPermissions[user_id]) == sorted(existing_perms):
+            logging.info(f"Permissions for User with id {user_id} required no changes")
+            return
+        permission_list = self.userPermissions[user_id]
+        permissionURL = f'{self.url}roles/users/{user_id}'
+        payload = self._permission_payload(user_id, permission_list)
+        logging.info(f"Updating user with id: {user_id} assigning the following permissions: {permission_list}")
+        request = await requester.put(permissionURL, payload)
+        self.writtenUsers.add(user_id)
+        if request.status_code == 404 and request.json()["errors"][0]["type"] == "EntityNotFoundException":
+            logging.warning(f"Keycloak user could not be found for user with Id: {user_id}")
+            userRequest = await requester.get(f'{self.url}users/{user_id}')
+            userRecord = self._keycloak_user_record(userRequest.json())
+            logging.info(f"Creating keycloak user record for user with id: {user_id}...")
+            keycloakRequest = await requester.post(f'{self.url}users-keycloak/users', userRecord)
+            self._keycloak_user_created(user_id, keycloakRequest)
+            request = await requester.put(permissionURL, payload)
+        if request.status_code == 200:
+            logging.info(f"Permissions updated for user with id: {user_id}")
+        else:
+            logging.warning(f"Permission update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
+
+    def _get_current_perms_batch(self, user_ids):
+        """Retrieves the role assignments for a batch of users, returns a dictionary of user id to role ids"""
+        # FOLIO compares ids case insensitively but returns them in lower case, so results are mapped back to the requested ids
+        requested = {user_id.lower(): user_id for user_id in user_ids}
+        userIdQuery = ' or '.join(cql_term(user_id) for user_id in requested)
+        current_perms = {user_id: [] for user_id in user_ids}
+        offset = 0
+        while True:
+            userRolesURL = f'{self.url}roles/users'
+            params = {'query': f'userId==({userIdQuery})', 'limit': 1000, 'offset': offset}
+            request = self.session.get(userRolesURL, params=params)
+            if request.status_code != 200:
+                logging.critical(f'User role lookup failed, response code: {request.status_code}, url: {userRolesURL}, params: {params}')
+                raise ValueError
+            user_roles = request.json()['userRoles']
+            for role in user_roles:
+                if role['userId'].lower() in requested:
+                    current_perms[requested[role['userId'].lower()]].append(role['roleId'])
+            if len(user_roles) < 1000:
+                return current_perms
+            offset += 1000
+
     def get_user_permissions_table(self):
         return str(self.userPermissions)
     
     def rebuild_permissions_csv(self):
         logging.info("Rebuilding Permissions csv file to match data in FOLIO...")
+        if self.userSubset:
+            logging.critical(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
+            raise RuntimeError(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
         currentUserPermissions = {}
         unique_perms = []
         
@@ -218,6 +297,10 @@ class RolesUpdater:
 
     def apply_user_permissions(self):
         logging.info("Applying Permissions in FOLIO...")
+        if self.httpBackend == 'async':
+            run_concurrently(self.session, self.maxInFlight, self._apply_user_permission_async, list(self.userPermissions.keys()), "Applying permissions in FOLIO")
+            logging.info("All permissions applied in FOLIO")
+            return 0
         for user_id in tqdm(self.userPermissions.keys(), desc= "Applying permissions in FOLIO"):
             updated = self._perm_comparison(user_id=user_id)
             if updated:
@@ -225,6 +308,68 @@ class RolesUpdater:
                 self._permission_put(user_id=user_id, permission_list=permissions)
         logging.info("All permissions applied in FOLIO")
         return 0
+
+    def verify_user_permissions(self, user_ids=None, retries=2):
+        """
+        Re-reads the roles of the users written by this updater (or the given users) in batches and compares them against the data file.
+        Mismatched users are updated again up to retries times.
+        Returns a dictionary of user id to (missing roles, unexpected roles) for the users still mismatched.
+        """
+        logging.info("Verifying Permissions in FOLIO...")
+        user_ids = [user_id for user_id in (self.writtenUsers if user_ids is None else user_ids) if user_id in self.userPermissions]
+        for attempt in range(retries + 1):
+            mismatches = {}
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Verifying permissions in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                current_perms = self._get_current_perms_batch(batch)
+                for user_id in batch:
+                    intended = set(self.userPermissions[user_id])
+                    existing = set(current_perms[user_id])
+                    if intended != existing:
+                        mismatches[user_id] = (intended - existing, existing - intended)
+            if not mismatches or attempt == retries:
+                break
+            logging.warning(f"{len(mismatches)} users do not match the data file, retrying update ({attempt + 1} of {retries})")
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                retries_submitted = [executor.submit(self._permission_put, user_id=user_id, permission_list=self.userPermissions[user_id])
+                                     for user_id in mismatches]
+                for retry in retries_submitted:
+                    retry.result()
+            user_ids = list(mismatches.keys())
+        for user_id, (missing, unexpected) in mismatches.items():
+            logging.error(f"Permissions mismatch for user with id: {user_id} missing: {sorted(missing)} unexpected: {sorted(unexpected)}")
+        logging.info(f"Permission verification complete, {len(mismatches)} users do not match the data file")
+        return mismatches
+
+    def apply_cohort_permissions(self, add=None, remove=None, column_index=None, column_value=None, query=None):
+        """
+        Adds and removes roles for every user selected by a userInfo column value or a CQL query against users.
+        Current roles are read in batches and only users whose roles change are updated.
+        """
+        logging.info("Applying cohort permission changes in FOLIO...")
+        permissionDict = self._permission_ids_lookup((add or []) + (remove or []))
+        add_ids = list(dict.fromkeys(permissionDict[permission] for permission in (add or [])))
+        remove_ids = {permissionDict[permission] for permission in (remove or [])}
+        user_ids = cohort_user_ids(self.session, self.url, self.userInfo, column_index=column_index, column_value=column_value, query=query)
+        logging.info(f"{len(user_ids)} users selected, adding the following permissions: {add_ids}, removing the following permissions: {list(remove_ids)}")
+        updates = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Applying cohort permissions in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                current_perms = self._get_current_perms_batch(batch)
+                for user_id in batch:
+                    existing_perms = current_perms[user_id]
+                    permissions = [perm for perm in existing_perms if perm not in remove_ids] + [perm for perm in add_ids if perm not in existing_perms]
+                    if permissions == existing_perms:
+                        logging.info(f"Permissions for User with id {user_id} required no changes")
+                        continue
+                    updates.append(executor.submit(self._permission_put, user_id=user_id, permission_list=permissions))
+            results = [update.result() for update in updates]
+        failed = [result[0] for result in results if result[1] != 200]
+        if failed:
+            logging.error(f"Cohort permissions update failed for {len(failed)} users: {failed}")
+        logging.info(f"Cohort permissions applied in FOLIO, {len(results) - len(failed)} users updated")
+        return 0
               
 
 if __name__ == '__main__':
@@ -3,12 +3,17 @@ import requests
 import os
 import csv
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from asyncRequester import run_concurrently
+from dataFileIndex import DataFileIndex
+from cohortSelector import cohort_user_ids
+from folioLookup import cql_term, batched_name_lookup
 from datetime import datetime
 import logging
 
 class ServicePointUpdater:
     
-    def __init__(self, envfile=None):
+    def __init__(self, envfile=None, user_ids=None, data_file_mode='full'):
         logging.info("Initializing Service Point Updater...")
 
         logging.info("Reading .env configuration file...")
@@ -23,6 +28,10 @@ class ServicePointUpdater:
             self.tenant = os.getenv('tenant')
             self.userFile = os.getenv('sp_file')
             self.userIdColumnIndex = int(os.getenv('user_id_column_index'))
+            self.batchSize = int(os.getenv('batch_size', 50))
+            self.maxWorkers = int(os.getenv('max_workers', 8))
+            self.httpBackend = os.getenv('http_backend', 'sync').lower()
+            self.maxInFlight = int(os.getenv('max_in_flight', 100))
         else:
             logging.critical(f".env file, \"{self.env}\"  not found or one or more required fields missing from .env")
             exit(".env file missing or required field(s) missing from .env")
@@ -40,39 +49,36 @@ class ServicePointUpdater:
         logging.info("Requester Session Initialized!")
 
         logging.info("Parsing Data file...")
+        # data_file_mode is 'full' to load and resolve every row, 'user_info' to load only the user data columns
+        # without resolving any names, or 'none' when users are selected by a query and the data file is not needed
+        self.userSubset = bool(user_ids) or data_file_mode != 'full'
         try:
-            with open(self.userFile, 'r') as file:
-                userServicePointReader = csv.reader(file, delimiter='\t')
-                # Prepares the user Service Points dictionary
+            if data_file_mode == 'none':
                 userServicePointsContents = []
-                for i, row in enumerate(userServicePointReader):
-                    if i >= 1 and row[self.userIdColumnIndex] != '':
-                        userServicePointsContents.append(row)
+            elif user_ids:
+                # Reads only the requested users' rows through the data file's row index
+                userServicePointsContents = DataFileIndex(self.userFile, self.userIdColumnIndex).rows(user_ids)
+            else:
+                with open(self.userFile, 'r') as file:
+                    userServicePointReader = csv.reader(file, delimiter='\t')
+                    # Prepares the user Service Points dictionary
+                    userServicePointsContents = []
+                    for i, row in enumerate(userServicePointReader):
+                        if i >= 1 and row[self.userIdColumnIndex] != '':
+                            userServicePointsContents.append(row)
         except Exception as e:
             logging.critical(f"Data file, \"{self.userFile}\" not found or was formatted incorrectly")
             raise e
-        servicePoints = []
-        servicePointDict = {}
         self.userServicePoints = {}
         self.userInfo = {}
-        for row in tqdm(userServicePointsContents, desc = "Parsing data file and looking up service point ids"):
-            self.userInfo[row[self.userIdColumnIndex]] = []
-            self.userServicePoints[row[self.userIdColumnIndex]] = []
-            for i, column in enumerate(row):
-                if i<self.userIdColumnIndex:
-                    self.userInfo[row[self.userIdColumnIndex]].append(column)
-                elif i>self.userIdColumnIndex and column != '':
-                    if column not in servicePoints:
-                        servicePoints.append(column)
-                        servicePointDict[column] = self._service_point_id_lookup(column)
-                    self.userServicePoints[row[self.userIdColumnIndex]].append(servicePointDict[column])
-        logging.info("Data file parsed successfully")
-
         for row in userServicePointsContents:
-            self.userServicePoints[row[self.userIdColumnIndex]] = []
-            for servicePoint in row[self.userIdColumnIndex+1:]:
-                if servicePoint != '':
-                    self.userServicePoints[row[self.userIdColumnIndex]].append(servicePointDict[servicePoint])
+            self.userInfo[row[self.userIdColumnIndex]] = row[:self.userIdColumnIndex]
+        if data_file_mode == 'full':
+            servicePointDict = self._service_point_ids_lookup(column for row in userServicePointsContents for column in row[self.userIdColumnIndex+1:] if column != '')
+            for row in tqdm(userServicePointsContents, desc = "Parsing data file"):
+                self.userServicePoints[row[self.userIdColumnIndex]] = [servicePointDict[column] for column in row[self.userIdColumnIndex+1:] if column != '']
+        logging.info("Data file parsed successfully")
+        self.writtenUsers = set()
         logging.info("Service Point Updater Initialized!")
     
     def _retrieve_token(self, user, password):
@@ -89,19 +95,18 @@ class ServicePointUpdater:
             return 0
 
         
-    def _service_point_id_lookup(self, service_point_name):
-        """Looks up a service point by name or code, returns the UUID for the Service Point."""    
-        sp_URL = f'{self.url}service-points?query=name=={service_point_name} OR code=={service_point_name}'
-        request = self.session.get(sp_URL)
-        if request.status_code != 200:
-            logging.critical(f'Service Point {service_point_name} not found, response code: {request.status_code}, url: {sp_URL}, headers: {self.session.headers}')
-            raise ValueError
-        response = request.json()
-        if len(response['servicepoints']) == 0:
-            logging.critical(f'Service Point {service_point_name} not found')
-            raise ValueError
-        sp_id = response['servicepoints'][0]['id']
-        return sp_id
+    def _service_point_ids_lookup(self, service_point_names):
+        """
+        Looks up service points by code, then by name for any not matched, in batches.
+        Returns a dictionary of each code or name to the UUID for the Service Point, raises ValueError listing every one not found.
+        """
+        servicePointDict, unresolved = batched_name_lookup(self.session, f'{self.url}service-points', service_point_names,
+                                                           ('code', 'name'), 'servicepoints', 'id',
+                                                           'limit', self.batchSize, "Looking up service point ids")
+        if unresolved:
+            logging.critical(f'Service Points not found: {unresolved}')
+            raise ValueError(f'Service Points not found: {unresolved}')
+        return servicePointDict
 
     def _service_point_name_lookup(self, service_point_id):
         """Takes a service point UUID and returns the service point's code"""
@@ -122,8 +127,16 @@ class ServicePointUpdater:
         """
         logging.info(f"Creating service point user record for user with id: {user_id}...")
         sp_user_creation_URL = self.url + 'service-points-users'
+        request = self.session.post(sp_user_creation_URL, data = self._service_point_user_record(user_id))
+        return self._service_point_user_created(user_id, request)
+
+    def _service_point_user_record(self, user_id):
+        """Returns the payload for creating an empty service point user record for a user"""
         payload = {"userId": user_id, "servicePointsIds": []}
-        request = self.session.post(sp_user_creation_URL, data = str(payload).replace("'",'"'))
+        return str(payload).replace("'",'"')
+
+    def _service_point_user_created(self, user_id, request):
+        """Checks the response to a service point user creation request, returns the new record's UUID or raises RuntimeError if it failed"""
         if request.status_code != 201:
             logging.critical(f'Service Point User creation for user with id: {user_id} failed, status code: {request.status_code}')
             raise RuntimeError
@@ -148,40 +161,108 @@ class ServicePointUpdater:
             current_default_sp = ''
         return sp_user_id, current_default_sp, current_service_points
 
+    def _service_points_match(self, user_id, current_default_sp, current_service_points):
+        """Returns True if the user's current service points and default service point match the data file"""
+        if set(self.userServicePoints[user_id]) != set(current_service_points):
+            return False
+        if len(self.userServicePoints[user_id]) == 0:
+            return current_default_sp == ''
+        return self.userServicePoints[user_id][0] == current_default_sp
+
     def _service_point_user_comparison(self, user_id):
         sp_user_id, current_default_sp, current_service_points = self._get_current_sps(user_id)
-        if set(self.userServicePoints[user_id]) == set(current_service_points) and len(self.userServicePoints[user_id])==len(current_default_sp) and len(self.userServicePoints[user_id]) == 0:
-            return False, ''
-        elif set(self.userServicePoints[user_id]) == set(current_service_points) and self.userServicePoints[user_id][0] == current_default_sp:
+        if self._service_points_match(user_id, current_default_sp, current_service_points):
             return False, ''
         else:
             return True, sp_user_id
 
-    def _service_point_put(self, user_id, sp_user_id, service_point_list):
-        sp_URL = f'{self.url}service-points-users/{sp_user_id}'
+    def _service_point_payload(self, user_id, sp_user_id, service_point_list):
         if len(service_point_list) != 0:
-            payload = str({
+            logging.info(f"Updating user with id: {user_id} and service point user id: {sp_user_id} assigning the following default service point: {service_point_list[0]} and the following service points: {service_point_list}")
+            return str({
                 'userId': user_id,
                 'servicePointsIds': service_point_list,
                 'defaultServicePointId': service_point_list[0],
                 'id': sp_user_id
             }).replace('\'','\"')
-            logging.info(f"Updating user with id: {user_id} and service point user id: {sp_user_id} assigning the following default service point: {service_point_list[0]} and the following service points: {service_point_list}")
-        else:
-            payload = str({
+        logging.info(f"Updating user with id: {user_id} and service point user id: {sp_user_id} removing all service point assignments")
+        return str({
             'id': sp_user_id,
             'userId': user_id,
             'servicePointsIds': service_point_list,
             'defaultServicePointId': 'null'
-            }).replace('\'','\"').replace('\"null\"', 'null')
-            logging.info(f"Updating user with id: {user_id} and service point user id: {sp_user_id} removing all service point assignments")
+        }).replace('\'','\"').replace('\"null\"', 'null')
+
+    def _service_point_put(self, user_id, sp_user_id, service_point_list):
+        sp_URL = f'{self.url}service-points-users/{sp_user_id}'
+        payload = self._service_point_payload(user_id, sp_user_id, service_point_list)
         request = self.session.put(sp_URL, data=str(payload))
+        self.writtenUsers.add(user_id)
         if request.status_code == 204:
             logging.info(f"Service points updated for user with id: {user_id}")
+        else:
+            logging.warning(f"Service point update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
         return [user_id, request.status_code, str(service_point_list), str(sp_URL), str(payload), str(self.session.headers)]
 
+    async def _apply_user_service_points_async(self, requester, user_id):
+        """Async backend equivalent of comparing and updating the service points of a single user"""
+        sp_user_URL = f'{self.url}service-points-users?query=userId=={user_id}'
+        request = await requester.get(sp_user_URL)
+        if request.status_code != 200:
+            logging.error(f'Service Point User lookup for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}')
+            raise RuntimeError
+        response = request.json()
+        if response['totalRecords'] == 0:
+            logging.warning(f'Service Point User record for user with id: {user_id} not found.')
+            logging.info(f"Creating service point user record for user with id: {user_id}...")
+            request = await requester.post(f'{self.url}service-points-users', self._service_point_user_record(user_id))
+            sp_user_id, current_default_sp, current_service_points = self._service_point_user_created(user_id, request), '', []
+        else:
+            sp_user = response['servicePointsUsers'][0]
+            sp_user_id, current_default_sp, current_service_points = sp_user['id'], sp_user.get('defaultServicePointId') or '', sp_user['servicePointsIds']
+        if self._service_points_match(user_id, current_default_sp, current_service_points):
+            logging.info(f"Service Points for User with id {user_id} required no changes")
+            return
+        payload = self._service_point_payload(user_id, sp_user_id, self.userServicePoints[user_id])
+        request = await requester.put(f'{self.url}service-points-users/{sp_user_id}', payload)
+        self.writtenUsers.add(user_id)
+        if request.status_code == 204:
+            logging.info(f"Service points updated for user with id: {user_id}")
+        else:
+            logging.warning(f"Service point update for user with id: {user_id} failed, status code: {request.status_code}, response: {request.text}")
+
+    def _get_current_sps_batch(self, user_ids, create_missing=True):
+        """
+        Retrieves the service point user records for a batch of users.
+        Returns a dictionary of user id to (service point user id, default service point, service points),
+        service point user records are created for users that do not have one unless create_missing is False,
+        in which case those users are left out of the dictionary.
+        """
+        # FOLIO compares ids case insensitively but returns them in lower case, so results are mapped back to the requested ids
+        requested = {user_id.lower(): user_id for user_id in user_ids}
+        userIdQuery = ' or '.join(cql_term(user_id) for user_id in requested)
+        sp_users_URL = f'{self.url}service-points-users'
+        params = {'query': f'userId==({userIdQuery})', 'limit': len(requested)}
+        request = self.session.get(sp_users_URL, params=params)
+        if request.status_code != 200:
+            logging.critical(f'Service Point User lookup failed, response code: {request.status_code}, url: {sp_users_URL}, params: {params}')
+            raise ValueError
+        current_sps = {}
+        for sp_user in request.json()['servicePointsUsers']:
+            if sp_user['userId'].lower() not in requested:
+                continue
+            current_sps[requested[sp_user['userId'].lower()]] = (sp_user['id'], sp_user.get('defaultServicePointId') or '', sp_user['servicePointsIds'])
+        for user_id in user_ids:
+            if user_id not in current_sps and create_missing:
+                logging.warning(f'Service Point User record for user with id: {user_id} not found.')
+                current_sps[user_id] = (self._create_service_point_user(user_id), '', [])
+        return current_sps
+
     def rebuild_service_points_csv(self):
         logging.info("Rebuilding Service Points csv file to match data in FOLIO...")
+        if self.userSubset:
+            logging.critical(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
+            raise RuntimeError(f"Data file, \"{self.userFile}\" was only loaded for a subset of users and cannot be rebuilt")
         currentUserSPs = {}
         unique_sps = []
         
@@ -233,6 +314,10 @@ class ServicePointUpdater:
 
     def apply_user_service_points(self):
         logging.info("Applying Service Points in FOLIO...")
+        if self.httpBackend == 'async':
+            run_concurrently(self.session, self.maxInFlight, self._apply_user_service_points_async, list(self.userServicePoints.keys()), "Applying Service Points in FOLIO")
+            logging.info("All service points applied in FOLIO.")
+            return 0
         for user in tqdm(self.userServicePoints.keys(), desc="Applying Service Points in FOLIO"):
             user_id = user
             update, sp_user_id = self._service_point_user_comparison(user_id=user_id)
@@ -242,6 +327,88 @@ class ServicePointUpdater:
                 logging.info(f"Service Points for User with id {user_id} required no changes")
         logging.info("All service points applied in FOLIO.")
         return 0
+
+    def verify_user_service_points(self, user_ids=None, retries=2):
+        """
+        Re-reads the service points of the users written by this updater (or the given users) in batches and compares them against the data file.
+        Mismatched users are updated again up to retries times.
+        Returns a dictionary of user id to (missing service points, unexpected service points, current default service point) for the users still mismatched.
+        """
+        logging.info("Verifying Service Points in FOLIO...")
+        user_ids = [user_id for user_id in (self.writtenUsers if user_ids is None else user_ids) if user_id in self.userServicePoints]
+        for attempt in range(retries + 1):
+            mismatches = {}
+            sp_user_ids = {}
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Verifying Service Points in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                # Verification only reads, missing service point user records are reported rather than created
+                current_sps = self._get_current_sps_batch(batch, create_missing=False)
+                for user_id in batch:
+                    if user_id not in current_sps:
+                        logging.warning(f'Service Point User record for user with id: {user_id} not found.')
+                        mismatches[user_id] = (set(self.userServicePoints[user_id]), set(), '')
+                        continue
+                    sp_user_id, current_default_sp, current_service_points = current_sps[user_id]
+                    if not self._service_points_match(user_id, current_default_sp, current_service_points):
+                        intended = set(self.userServicePoints[user_id])
+                        existing = set(current_service_points)
+                        mismatches[user_id] = (intended - existing, existing - intended, current_default_sp)
+                        sp_user_ids[user_id] = sp_user_id
+            if not sp_user_ids or attempt == retries:
+                break
+            logging.warning(f"{len(mismatches)} users do not match the data file, retrying update ({attempt + 1} of {retries})")
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                retries_submitted = [executor.submit(self._service_point_put, user_id, sp_user_id, self.userServicePoints[user_id])
+                                     for user_id, sp_user_id in sp_user_ids.items()]
+                for retry in retries_submitted:
+                    retry.result()
+            user_ids = list(mismatches.keys())
+        for user_id, (missing, unexpected, current_default_sp) in mismatches.items():
+            logging.error(f"Service Points mismatch for user with id: {user_id} missing: {sorted(missing)} unexpected: {sorted(unexpected)} current default: {current_default_sp}")
+        logging.info(f"Service Point verification complete, {len(mismatches)} users do not match the data file")
+        return mismatches
+
+    def apply_cohort_service_points(self, add=None, remove=None, default=None, column_index=None, column_value=None, query=None):
+        """
+        Adds and removes service points for every user selected by a userInfo column value or a CQL query against users.
+        If a default service point is given it is assigned and set as the default, otherwise the current default is kept where possible.
+        Current service points are read in batches and only users whose service points change are updated.
+        """
+        logging.info("Applying cohort service point changes in FOLIO...")
+        servicePointDict = self._service_point_ids_lookup((add or []) + (remove or []) + ([default] if default else []))
+        add_ids = list(dict.fromkeys(servicePointDict[sp] for sp in (add or [])))
+        remove_ids = {servicePointDict[sp] for sp in (remove or [])}
+        default_id = servicePointDict[default] if default else ''
+        if default_id and default_id not in add_ids:
+            add_ids.append(default_id)
+        user_ids = cohort_user_ids(self.session, self.url, self.userInfo, column_index=column_index, column_value=column_value, query=query)
+        logging.info(f"{len(user_ids)} users selected, adding the following service points: {add_ids}, removing the following service points: {list(remove_ids)}, default service point: {default_id}")
+        updates = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for i in tqdm(range(0, len(user_ids), self.batchSize), desc="Applying cohort service points in FOLIO"):
+                batch = user_ids[i:i+self.batchSize]
+                current_sps = self._get_current_sps_batch(batch)
+                for user_id in batch:
+                    sp_user_id, current_default_sp, current_service_points = current_sps[user_id]
+                    service_points = [sp for sp in current_service_points if sp not in remove_ids] + [sp for sp in add_ids if sp not in current_service_points]
+                    if default_id:
+                        new_default_sp = default_id
+                    elif current_default_sp in service_points:
+                        new_default_sp = current_default_sp
+                    else:
+                        new_default_sp = service_points[0] if service_points else ''
+                    if set(service_points) == set(current_service_points) and new_default_sp == current_default_sp:
+                        logging.info(f"Service Points for User with id {user_id} required no changes")
+                        continue
+                    # The first service point in the list is assigned as the default
+                    service_points = [new_default_sp] + [sp for sp in service_points if sp != new_default_sp] if service_points else []
+                    updates.append(executor.submit(self._service_point_put, user_id, sp_user_id, service_points))
+            results = [update.result() for update in updates]
+        failed = [result[0] for result in results if result[1] != 204]
+        if failed:
+            logging.error(f"Cohort service points update failed for {len(failed)} users: {failed}")
+        logging.info(f"Cohort service points applied in FOLIO, {len(results) - len(failed)} users updated")
+        return 0
               
 
 if __name__ == '__main__':